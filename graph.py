@@ -1,6 +1,8 @@
 # Graph class
+import sys
 import numpy as np
-from node import FacNode, VarNode
+from collections import OrderedDict
+from node import FacNode, VarNode, normalize, scaled_product
 import pdb
 
 """ Factor Graph classes forming structure for PGMs
@@ -12,19 +14,34 @@ import pdb
 
 class Graph:
     """ Putting everything together
+        dtype - float type of all messages and factor tables
+            (np.float32 halves memory traffic, np.float64 for accuracy)
+        cache_bytes - memory budget for caching marginals by evidence,
+            least recently used results evicted first (0 disables cache)
+            sizes come from sys.getsizeof so the budget is approximate
     """
     
-    def __init__(self):
+    def __init__(self, dtype=np.float64, cache_bytes=0):
         self.var = {}
         self.fac = []
         self.dims = []
+        self.dtype = dtype
         self.converged = False
         
+        self.version = 0  # bumped whenever structure or factors change
+        self.cache_bytes = cache_bytes
+        self.cache = OrderedDict()  # oldest first
+        self.cache_used = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cached_log_z = None  # log Z for last cache hit, messages not updated
+        
     def add_var_node(self, name, dim):
         new_id = len(self.var)
-        new_var = VarNode(name, dim, new_id)
+        new_var = VarNode(name, dim, new_id, self.dtype)
         self.var[name] = new_var
         self.dims.append(dim)
+        self.structure_changed()
         
         return new_var
     
@@ -32,9 +49,55 @@ class Graph:
         new_id = len(self.fac)
         new_fac = FacNode(P, new_id, *args)
         self.fac.append(new_fac)
+        self.structure_changed()
         
         return new_fac
     
+    def structure_changed(self):
+        """ Invalidate cached marginals
+            Call this after editing factor tables in place
+        """
+        self.version += 1
+        self.clear_cache()
+    
+    def clear_cache(self):
+        """ Drop all cached marginals, keeping hit/miss counts
+        """
+        self.cache = OrderedDict()
+        self.cache_used = 0
+    
+    def cache_info(self):
+        """ Hit and miss statistics for marginal cache
+        """
+        return {'hits': self.cache_hits, 'misses': self.cache_misses,
+                'entries': len(self.cache), 'bytes': self.cache_used,
+                'max_bytes': self.cache_bytes}
+    
+    def evidence_key(self, max_steps):
+        """ Canonical key for current evidence and enabled subgraph
+            Only observed vars and disabled nodes are listed,
+            so keys stay small when most of the graph is default
+        """
+        observed = tuple(sorted((k, v.observed) for k, v in self.var.iteritems() if v.observed >= 0))
+        disabled = tuple(sorted(k for k, v in self.var.iteritems() if not v.enabled))
+        disabled_fac = tuple(i for i, f in enumerate(self.fac) if not f.enabled)
+        return (self.version, max_steps, observed, disabled, disabled_fac)
+    
+    @staticmethod
+    def cache_entry_size(key, marginals):
+        """ Approximate memory held by one cache entry: key tuples,
+            dict and arrays (getsizeof includes data owned by arrays)
+        """
+        def tuple_size(x):
+            size = sys.getsizeof(x)
+            if isinstance(x, tuple):
+                size += sum(tuple_size(y) for y in x)
+            return size
+        
+        size = tuple_size(key) + sys.getsizeof(marginals)
+        size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in marginals.iteritems())
+        return size
+    
     def disable_all(self):
         """ Disable all nodes in graph
             Useful for switching on small subnetworks
@@ -53,6 +116,7 @@ class Graph:
         for f in self.fac:
             f.reset()
         self.converged = False
+        self.cached_log_z = None
     
     def sum_product(self, max_steps=500):
         """ This is the algorithm!
@@ -61,6 +125,8 @@ class Graph:
             then push outgoing to neighbors' incoming
             check outgoing v. previous outgoing to check for convergence
         """
+        self.cached_log_z = None
+        
         # loop to convergence
         time_step = 0
         while time_step < max_steps and not self.converged:  # run for max_steps cycles
@@ -100,27 +166,99 @@ class Graph:
     def marginals(self, max_steps=500):
         """ Return dictionary of all marginal distributions
             indexed by corresponding variable name
+            If cache is enabled and evidence was seen before,
+            message passing is skipped (node messages aren't updated,
+            log_partition returns the cached value instead)
         """
+        if self.cache_bytes > 0:
+            key = self.evidence_key(max_steps)
+            if key in self.cache:
+                self.cache_hits += 1
+                cached, log_z = self.cache.pop(key)
+                self.cache[key] = (cached, log_z)  # move to most recently used
+                self.cached_log_z = log_z
+                return dict((k, v.copy()) for k, v in cached.iteritems())
+            self.cache_misses += 1
+        
         # Message pass
+        # if already converged, messages may be from other evidence
+        # (condition() w/o reset()), so don't cache the result
+        passed = not self.converged
         self.sum_product(max_steps)
         
         marginals = {}
         # for each var
         for k, v in self.var.iteritems():
             if v.enabled:  # only include enabled variables
-                # multiply together messages
-                v_marginal = 1
-                for i in xrange(0, len(v.incoming)):
-                    v_marginal = v_marginal * v.incoming[i]
-            
-                # normalize
-                n = np.sum(v_marginal)
-                v_marginal = v_marginal / n
+                # multiply together messages, normalizing as we go
+                v_marginal = scaled_product(v.incoming, np.ones((v.dim, 1), v.dtype))[0]
             
                 marginals[k] = v_marginal
         
+        if self.cache_bytes > 0 and passed and self.converged:
+            self.cache_marginals(key, marginals)
+        
         return marginals
     
+    def cache_marginals(self, key, marginals):
+        """ Store copy of marginals and log Z, evicting least recently
+            used entries until within memory budget
+        """
+        stored = dict((k, v.copy()) for k, v in marginals.iteritems())
+        size = self.cache_entry_size(key, stored)
+        if size > self.cache_bytes:
+            return
+        while self.cache_used + size > self.cache_bytes:
+            old_key, (old, old_log_z) = self.cache.popitem(last=False)
+            self.cache_used -= self.cache_entry_size(old_key, old)
+        self.cache[key] = (stored, self.log_partition())
+        self.cache_used += size
+    
+    def log_partition(self):
+        """ Log of normalizing constant Z, recovered from message scales
+            Call after sum_product. Exact for tree-structured graphs:
+            root each connected component at a var, then
+            Z = (sum over root of product of incoming messages)
+                * (scales of all messages directed toward the root)
+            Only enabled nodes are included.
+            After a cache hit in marginals, returns the cached value
+        """
+        if self.cached_log_z is not None:
+            return self.cached_log_z
+        
+        log_z = 0.
+        visited = set()
+        for k, root in self.var.iteritems():
+            if not root.enabled or root in visited:
+                continue
+            visited.add(root)
+            
+            # local sum at root, restricted to observation if any
+            local, log_scale = scaled_product(root.incoming, np.ones((root.dim, 1), np.float64))
+            log_z += log_scale
+            if root.observed >= 0:
+                log_z += np.log(float(local[root.observed]))
+            
+            # walk away from root adding scales of messages sent back toward it
+            stack = [root]
+            while stack:
+                parent = stack.pop()
+                for child in parent.neighbors:
+                    if not child.enabled or child in visited:
+                        continue
+                    visited.add(child)
+                    i = child.neighbors.index(parent)
+                    log_z += child.log_scales[i]
+                    if getattr(child, 'observed', -1) >= 0:
+                        # indicator message drops what the rest of the subtree
+                        # sent in, so add it back at the observed value
+                        for j in xrange(0, len(child.incoming)):
+                            if j != i:
+                                log_z += np.log(float(child.incoming[j][child.observed]))
+                    stack.append(child)
+        
+        return log_z
+    
     def brute_force(self):
         """ Brute force method. Only here for completeness.
             Don't use unless you want your code to take forever to produce results.
@@ -201,3 +339,107 @@ class Graph:
         del sum_out[brute['names'].index(var)]
         marg = np.sum(brute['joint'], tuple(sum_out))
         return marg / np.sum(marg)  # normalize to sum to one
+
+
+class StreamingGraph(Graph):
+    """ Fixed-lag smoothing for HMM-style chains
+        Only the last lag+1 time slices are kept as a graph.
+        Each new slice is filtered by passing one message forward;
+        the oldest slice is then summarized into a unary boundary
+        factor on its successor and freed, so cost and memory per
+        observation stay constant.
+    """
+    
+    def __init__(self, prior, transition, lag, dtype=np.float64, cache_bytes=0):
+        Graph.__init__(self, dtype, cache_bytes)
+        self.prior = np.reshape(np.asarray(prior, dtype), (-1, 1))
+        # P[new, prev], as in add_fac_node(P, new, prev)
+        self.transition = np.asarray(transition, dtype)
+        self.dim = self.prior.shape[0]
+        self.lag = lag
+        self.time = 0
+        self.slices = []  # (var, [transition or boundary fac, emission fac]) per slice
+        self.filtered_messages = []  # forward (filtering) message per slice
+    
+    def add_var_node(self, name, dim):
+        """ Window is managed by slices, so nodes can't be added directly
+        """
+        raise TypeError("StreamingGraph only supports add_time_slice")
+    
+    def add_fac_node(self, P, *args):
+        raise TypeError("StreamingGraph only supports add_time_slice")
+    
+    def add_time_slice(self, name, likelihood, transition=None):
+        """ Append a new time slice with observation likelihood p(y_t|x_t)
+            transition - optional P[new, prev] to override the default
+            Returns new variable node
+        """
+        if transition is None:
+            transition = self.transition
+        transition = np.asarray(transition, self.dtype)
+        likelihood = np.reshape(np.asarray(likelihood, self.dtype), (self.dim, 1))
+        if name in self.var:
+            raise ValueError("Variable %s is already in the window" % name)
+        if transition.shape != (self.dim, self.dim):
+            raise ValueError("Transition must have shape (%d, %d)" % (self.dim, self.dim))
+        
+        # forward message: predict from last slice then absorb evidence
+        # done before touching the window so errors leave it intact
+        if self.slices:
+            predicted = np.dot(transition, self.filtered_messages[-1])
+        else:
+            predicted = self.prior
+        alpha = normalize(predicted * likelihood)[0]
+        
+        # var nids must stay unique once old slices are freed, so use time
+        # (factor nids aren't used for lookups, so slice factors share it)
+        new_var = VarNode(name, self.dim, self.time, self.dtype)
+        self.var[name] = new_var
+        self.dims.append(self.dim)
+        
+        if self.slices:
+            prev_var = self.slices[-1][0]
+            link = FacNode(transition, self.time, new_var, prev_var)
+        else:
+            link = FacNode(self.prior, self.time, new_var)
+        emission = FacNode(likelihood, self.time, new_var)
+        self.fac.extend([link, emission])
+        
+        self.filtered_messages.append(alpha)
+        self.slices.append((new_var, [link, emission]))
+        self.time += 1
+        
+        # free anything older than the window
+        while len(self.slices) > self.lag + 1:
+            self.drop_oldest_slice()
+        
+        self.structure_changed()
+        self.converged = False
+        return new_var
+    
+    def drop_oldest_slice(self):
+        """ Summarize oldest slice into a boundary message on its successor
+            boundary = p(x_s+1 | y_1:s), so marginals over the window
+            are still exact fixed-lag smoothed marginals
+        """
+        old_var, old_facs = self.slices.pop(0)
+        old_alpha = self.filtered_messages.pop(0)
+        next_var, next_facs = self.slices[0]
+        
+        # replace link to old slice w/ unary boundary factor
+        link = next_facs[0]
+        next_var.remove_neighbor(link)
+        boundary = normalize(np.dot(link.P, old_alpha))[0]
+        boundary = FacNode(boundary, link.nid, next_var)
+        next_facs[0] = boundary
+        
+        for f in old_facs + [link]:
+            self.fac.remove(f)
+        self.fac.append(boundary)
+        del self.var[old_var.name]
+        del self.dims[0]
+    
+    def filtered(self):
+        """ Filtered distribution p(x_t | y_1:t) for newest slice
+        """
+        return self.filtered_messages[-1]
@@ -1,5 +1,6 @@
-from graph import Graph
+from graph import Graph, StreamingGraph
 import numpy as np
+import sys
 
 """ Graphs for testing sum product implementation
 """
@@ -157,7 +158,258 @@ def test_test_graph():
     assert check_eq(dm[4], dmm[4])
     
     print "All tests passed!"
+
+
+def make_chain_model():
+    """ 3 state HMM w/ sequence of observation likelihoods
+        transition indexed P[new, prev]
+    """
+    prior = np.array([[0.5], [0.3], [0.2]])
+    transition = np.array([[0.8, 0.1, 0.2],
+                           [0.1, 0.7, 0.3],
+                           [0.1, 0.2, 0.5]])
+    likelihoods = [np.array([[0.9], [0.2], [0.1]]),
+                   np.array([[0.1], [0.8], [0.3]]),
+                   np.array([[0.2], [0.7], [0.4]]),
+                   np.array([[0.6], [0.1], [0.5]]),
+                   np.array([[0.1], [0.3], [0.9]]),
+                   np.array([[0.4], [0.4], [0.2]])]
+    return prior, transition, likelihoods
+
+
+def test_streaming_graph():
+    """ Fixed-lag window should match full chain over the same slices
+    """
+    prior, transition, likelihoods = make_chain_model()
+    lag = 2
+    
+    full_graph = Graph()
+    stream_graph = StreamingGraph(prior, transition, lag)
+    prev = None
+    for t in xrange(0, len(likelihoods)):
+        name = 'x%d' % t
+        x = full_graph.add_var_node(name, 3)
+        if prev is None:
+            full_graph.add_fac_node(prior, x)
+        else:
+            full_graph.add_fac_node(transition, x, prev)
+        full_graph.add_fac_node(likelihoods[t], x)
+        prev = x
+        
+        stream_graph.add_time_slice(name, likelihoods[t])
+    
+    # window is bounded
+    assert len(stream_graph.var) == lag + 1
+    assert len(stream_graph.fac) == 2 * (lag + 1)
+    
+    full_marginals = full_graph.marginals()
+    stream_marginals = stream_graph.marginals()
+    assert sorted(stream_marginals.keys()) == ['x3', 'x4', 'x5']
+    for k, v in stream_marginals.iteritems():
+        for i in xrange(0, 3):
+            assert check_eq(v[i], full_marginals[k][i])
+    
+    # filtering on newest slice equals smoothing on it
+    f = stream_graph.filtered()
+    for i in xrange(0, 3):
+        assert check_eq(f[i], full_marginals['x5'][i])
+    
+    # names must be unique within window, nodes only added as slices
+    for add in [lambda: stream_graph.add_time_slice('x5', likelihoods[0]),
+                lambda: stream_graph.add_var_node('y', 3)]:
+        try:
+            add()
+            assert False
+        except (ValueError, TypeError):
+            pass
+    assert len(stream_graph.var) == lag + 1
+    
+    # bad transition leaves window untouched, so retrying works
+    try:
+        stream_graph.add_time_slice('x6', likelihoods[0], np.ones((2, 3)))
+        assert False
+    except ValueError:
+        pass
+    assert len(stream_graph.var) == lag + 1
+    assert len(stream_graph.fac) == 2 * (lag + 1)
+    assert len(stream_graph.var['x5'].neighbors) == 2
+    stream_graph.add_time_slice('x6', likelihoods[0])
+    assert sorted(stream_graph.var.keys()) == ['x4', 'x5', 'x6']
+    
+    print "All tests passed!"
+
+
+def test_log_partition():
+    """ Partition function from message scales vs summing out factors
+    """
+    test_graph = make_test_graph()
+    test_graph.marginals()
+    p = [f.P for f in test_graph.fac]
+    
+    z = np.einsum('a,ba,dca->', p[0][:, 0], p[1], p[2])
+    assert check_eq(test_graph.log_partition(), np.log(z))
+    
+    # observing a var in the middle of the graph
+    test_graph.reset()
+    test_graph.var['a'].condition(1)
+    test_graph.marginals()
+    z = p[0][1, 0] * np.sum(p[1][:, 1]) * np.sum(p[2][:, :, 1])
+    assert check_eq(test_graph.log_partition(), np.log(z))
+    
+    print "All tests passed!"
+
+
+def test_float32_graph():
+    """ float32 messages match float64 and survive underflow
+    """
+    test_graph = make_test_graph()
+    marginals = test_graph.marginals()
+    
+    test_graph32 = Graph(np.float32)
+    for k, v in sorted(test_graph.var.items(), key=lambda x: x[1].nid):
+        test_graph32.add_var_node(k, v.dim)
+    for f in test_graph.fac:
+        test_graph32.add_fac_node(f.P, *[test_graph32.var[v.name] for v in f.neighbors])
+    marginals32 = test_graph32.marginals()
+    
+    for k, v in marginals32.iteritems():
+        assert v.dtype == np.float32
+        assert (np.absolute(v - marginals[k]) < 10**-4).all()
+    
+    # product of incoming messages underflows in float32 unless rescaled
+    tiny_graph = Graph(np.float32)
+    a = tiny_graph.add_var_node('a', 2)
+    for p in [[1, 1e-30], [1e-30, 1], [1, 1e-30], [1e-20, 1]]:
+        tiny_graph.add_fac_node(np.array(p).reshape(2, 1), a)
+    tiny_marginals = tiny_graph.marginals()
+    assert check_eq(tiny_marginals['a'][0], 1.)
+    assert abs(tiny_marginals['a'][1] / 1e-10 - 1.) < 10**-4
+    
+    # contradictory evidence shows up as zeros, not NaN or uniform
+    bad_graph = Graph()
+    a = bad_graph.add_var_node('a', 2)
+    b = bad_graph.add_var_node('b', 2)
+    bad_graph.add_fac_node(np.eye(2), a, b)
+    bad_graph.add_fac_node(np.array([[1.], [0.]]), a)
+    b.condition(1)
+    bad_marginals = bad_graph.marginals()
+    assert (bad_marginals['a'] == 0).all()
+    
+    print "All tests passed!"
+
+
+def test_marginal_cache():
+    """ Repeated evidence served from cache, structure change invalidates
+    """
+    test_graph = make_test_graph()
+    test_graph.cache_bytes = 10**6
+    
+    first = test_graph.marginals()
+    # room for two entries but not three
+    test_graph.cache_bytes = int(2.5 * test_graph.cache_info()['bytes'])
+    test_graph.reset()
+    test_graph.var['c'].condition(2)
+    observed = test_graph.marginals()
+    test_graph.reset()
+    again = test_graph.marginals()
+    info = test_graph.cache_info()
+    assert info['hits'] == 1 and info['misses'] == 2 and info['entries'] == 2
+    assert check_eq(again['d'][1], first['d'][1])
+    
+    # evidence set a new entry, least recently used one evicted
+    test_graph.var['a'].condition(0)
+    test_graph.marginals()
+    test_graph.reset()
+    test_graph.var['c'].condition(2)
+    test_graph.marginals()
+    info = test_graph.cache_info()
+    assert info['hits'] == 1 and info['misses'] == 4 and info['entries'] == 2
+    
+    # new factor invalidates everything
+    test_graph.add_fac_node(np.array([[0.9], [0.1]]), test_graph.var['a'])
+    assert test_graph.cache_info()['entries'] == 0
+    test_graph.reset()
+    test_graph.var['c'].condition(2)
+    changed = test_graph.marginals()
+    assert test_graph.cache_info()['misses'] == 5
+    assert not check_eq(changed['a'][0], observed['a'][0])
+    
+    # log Z still available when message passing is skipped
+    log_z = test_graph.log_partition()
+    test_graph.reset()
+    test_graph.var['c'].condition(2)
+    test_graph.marginals()
+    assert test_graph.cache_info()['hits'] == 2
+    assert check_eq(test_graph.log_partition(), log_z)
+    
+    # conditioning w/o reset doesn't rerun message passing,
+    # so that result must not be cached under the new evidence
+    test_graph = make_test_graph()
+    test_graph.cache_bytes = 10**6
+    first = test_graph.marginals()
+    test_graph.var['c'].condition(2)
+    test_graph.marginals()
+    test_graph.reset()
+    test_graph.var['c'].condition(2)
+    conditioned = test_graph.marginals()
+    assert test_graph.cache_info()['hits'] == 0
+    assert not check_eq(conditioned['a'][0], first['a'][0])
+    
+    uncached_graph = make_test_graph()
+    uncached_graph.var['c'].condition(2)
+    expected = uncached_graph.marginals()
+    for k, v in conditioned.iteritems():
+        assert (np.absolute(v - expected[k]) < 10**-6).all()
+    
+    print "All tests passed!"
+
+
+def deep_size(x):
+    """ sys.getsizeof summed through tuples and dicts
+    """
+    size = sys.getsizeof(x)
+    if isinstance(x, tuple):
+        size += sum(deep_size(y) for y in x)
+    elif isinstance(x, dict):
+        size += sum(deep_size(k) + deep_size(v) for k, v in x.iteritems())
+    return size
+
+
+def test_cache_budget():
+    """ Cache size counts key and object overhead, not just array data
+    """
+    chain_graph = Graph(cache_bytes=10**6)
+    prev = None
+    for t in xrange(0, 200):
+        x = chain_graph.add_var_node('x%d' % t, 2)
+        if prev is None:
+            chain_graph.add_fac_node(np.array([[0.6], [0.4]]), x)
+        else:
+            chain_graph.add_fac_node(np.array([[0.9, 0.2], [0.1, 0.8]]), x, prev)
+        prev = x
+    for t in xrange(0, 200, 10):
+        chain_graph.var['x%d' % t].condition(t % 2)
+    chain_graph.marginals()
+    
+    key, (marginals, log_z) = chain_graph.cache.items()[0]
+    real_size = deep_size(key) + deep_size(marginals)
+    assert chain_graph.cache_info()['bytes'] >= real_size
+    assert chain_graph.cache_info()['bytes'] > 2 * sum(v.nbytes for v in marginals.itervalues())
+    
+    # entry bigger than budget isn't stored
+    chain_graph.reset()
+    chain_graph.cache_bytes = real_size / 2
+    chain_graph.clear_cache()
+    chain_graph.marginals()
+    assert chain_graph.cache_info()['entries'] == 0
+    
+    print "All tests passed!"
     
 # standard run of test cases
 test_toy_graph()
-test_test_graph()
\ No newline at end of file
+test_test_graph()
+test_streaming_graph()
+test_log_partition()
+test_float32_graph()
+test_marginal_cache()
+test_cache_budget()
\ No newline at end of file
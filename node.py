@@ -10,6 +10,30 @@ import pdb
 """
 
 
+def normalize(x):
+    """ Normalize to sum to 1
+        Returns normalized array and log of the scale divided out
+        All-zero input (contradictory evidence) is returned as is
+        with log scale -inf rather than dividing by zero
+    """
+    n = np.sum(x)
+    if not n > 0:
+        return x, -np.inf
+    return x / n, np.log(float(n))
+
+
+def scaled_product(arrays, start):
+    """ Multiply arrays into start, normalizing after each step
+        so the running product can't underflow to zero
+        Returns normalized product and log of the scale divided out
+    """
+    product, log_scale = normalize(start)
+    for x in arrays:
+        product, s = normalize(product * x)
+        log_scale += s
+    return product, log_scale
+
+
 class Node(object):
     """ Superclass for graph nodes
     """
@@ -22,6 +46,7 @@ class Node(object):
         self.incoming = []
         self.outgoing = []
         self.old_outgoing = []
+        self.log_scales = []  # log of factor divided out of each outgoing message
     
     def reset(self):
         self.enabled = True
@@ -42,9 +67,22 @@ class Node(object):
         self.old_outgoing = self.outgoing[:]
     
     def normalize_messages(self):
-        """ Normalize to sum to 1
+        """ Normalize to sum to 1, adding to scales for partition function
         """
-        self.outgoing = [x / np.sum(x) for x in self.outgoing]
+        for i in xrange(0, len(self.outgoing)):
+            self.outgoing[i], s = normalize(self.outgoing[i])
+            self.log_scales[i] += s
+    
+    def remove_neighbor(self, node):
+        """ Detach neighbor and drop the messages on that edge
+            Only removes this side of the edge
+        """
+        i = self.neighbors.index(node)
+        del self.neighbors[i]
+        del self.incoming[i]
+        del self.outgoing[i]
+        del self.old_outgoing[i]
+        del self.log_scales[i]
     
     def receive_message(self, node, message):
         """ Places new message into correct location in new message list
@@ -78,18 +116,20 @@ class Node(object):
 class VarNode(Node):
     """ Variable node in factor graph
     """
-    def __init__(self, name, dim, nid):
+    def __init__(self, name, dim, nid, dtype=np.float64):
         super(VarNode, self).__init__(nid)
         self.name = name
         self.dim = dim
+        self.dtype = dtype  # shared by all messages on this var's edges
         self.observed = -1  # only >= 0 if variable is observed
     
     def reset(self):
         super(VarNode, self).reset()
         size = range(0, len(self.incoming))
-        self.incoming = [np.ones((self.dim, 1)) for i in size]
-        self.outgoing = [np.ones((self.dim, 1)) for i in size]
-        self.old_outgoing = [np.ones((self.dim, 1)) for i in size]
+        self.incoming = [np.ones((self.dim, 1), self.dtype) for i in size]
+        self.outgoing = [np.ones((self.dim, 1), self.dtype) for i in size]
+        self.old_outgoing = [np.ones((self.dim, 1), self.dtype) for i in size]
+        self.log_scales = [0. for i in size]
         self.observed = -1
     
     def condition(self, observation):
@@ -99,8 +139,9 @@ class VarNode(Node):
         self.observed = observation
         # set messages (won't change)
         for i in xrange(0, len(self.outgoing)):
-            self.outgoing[i] = np.zeros((self.dim, 1))
+            self.outgoing[i] = np.zeros((self.dim, 1), self.dtype)
             self.outgoing[i][self.observed] = 1.
+            self.log_scales[i] = 0.
         self.next_step()  # copy into old_outgoing
     
     def prep_messages(self):
@@ -114,7 +155,7 @@ class VarNode(Node):
                 # multiply together all excluding message at current index
                 curr = self.incoming[:]
                 del curr[i]
-                self.outgoing[i] = reduce(np.multiply, curr)
+                self.outgoing[i], self.log_scales[i] = scaled_product(curr[1:], curr[0])
         
             # normalize once finished with all messages
             self.normalize_messages()
@@ -125,8 +166,10 @@ class FacNode(Node):
     """
     def __init__(self, P, nid, *args):
         super(FacNode, self).__init__(nid)
-        self.P = P
         self.neighbors = list(args)  # list storing refs to variable nodes
+        # messages (and so P) use dtype of the connected variables
+        self.dtype = self.neighbors[0].dtype if self.neighbors else np.float64
+        self.P = np.asarray(P, self.dtype)
         
         # num of edges
         n_neighbors = len(self.neighbors)
@@ -138,16 +181,18 @@ class FacNode(Node):
             vdim = v.dim
             
             # init for factor
-            self.incoming.append(np.ones((vdim, 1)))
-            self.outgoing.append(np.ones((vdim, 1)))
-            self.old_outgoing.append(np.ones((vdim, 1)))
+            self.incoming.append(np.ones((vdim, 1), self.dtype))
+            self.outgoing.append(np.ones((vdim, 1), self.dtype))
+            self.old_outgoing.append(np.ones((vdim, 1), self.dtype))
+            self.log_scales.append(0.)
 
             # TODO: do this in an add_neighbor function in the VarNode class!
             # init for variable
             v.neighbors.append(self)
-            v.incoming.append(np.ones((vdim, 1)))
-            v.outgoing.append(np.ones((vdim, 1)))
-            v.old_outgoing.append(np.ones((vdim, 1)))
+            v.incoming.append(np.ones((vdim, 1), self.dtype))
+            v.outgoing.append(np.ones((vdim, 1), self.dtype))
+            v.old_outgoing.append(np.ones((vdim, 1), self.dtype))
+            v.log_scales.append(0.)
         
         # error check
         assert (n_neighbors == n_dependencies), "Factor dimensions does not match size of domain."
@@ -155,9 +200,10 @@ class FacNode(Node):
     def reset(self):
         super(FacNode, self).reset()
         for i in xrange(0, len(self.incoming)):
-            self.incoming[i] = np.ones((self.neighbors[i].dim, 1))
-            self.outgoing[i] = np.ones((self.neighbors[i].dim, 1))
-            self.old_outgoing[i] = np.ones((self.neighbors[i].dim, 1))
+            self.incoming[i] = np.ones((self.neighbors[i].dim, 1), self.dtype)
+            self.outgoing[i] = np.ones((self.neighbors[i].dim, 1), self.dtype)
+            self.old_outgoing[i] = np.ones((self.neighbors[i].dim, 1), self.dtype)
+            self.log_scales[i] = 0.
     
     def prep_messages(self):
         """ Multiplies incoming messages w/ P to make new outgoing
@@ -168,6 +214,17 @@ class FacNode(Node):
         
             n_messages = len(self.incoming)
         
+            # rescale incoming to max 1 so factor-sized products can't underflow
+            # cheap since messages are only dim-sized before tiling
+            log_maxes = []
+            for i in xrange(0, n_messages):
+                m = np.max(self.incoming[i])
+                if m > 0:
+                    self.incoming[i] = self.incoming[i] / m
+                    log_maxes.append(np.log(float(m)))
+                else:
+                    log_maxes.append(-np.inf)
+        
             # do tiling in advance
             # roll axes to match shape of newMessage after
             for i in xrange(0, n_messages):
@@ -188,6 +245,7 @@ class FacNode(Node):
                 curr = self.incoming[:]
                 del curr[i]
                 new_message = reduce(np.multiply, curr, self.P)
+                self.log_scales[i] = sum(log_maxes[:i] + log_maxes[i+1:])
                     
                 # sum over all vars except i!
                 # roll axis i to front then sum over all other axes